@@ -1,2 +1,3 @@
 import batch.client
 import batch.api
+import batch.worker
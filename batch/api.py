@@ -36,10 +36,19 @@ def cancel_job(url, job_id):
     r.raise_for_status()
     return r.json()
 
-def create_batch(url, attributes):
+def list_warm_pools(url):
+    r = requests.get(url + '/warm_pools')
+    r.raise_for_status()
+    return r.json()
+
+def create_batch(url, attributes, pack_size=None, pack_parallelism=None):
     d = {}
     if attributes:
         d['attributes'] = attributes
+    if pack_size:
+        d['pack_size'] = pack_size
+    if pack_parallelism:
+        d['pack_parallelism'] = pack_parallelism
     r = requests.post(url + '/batches/create', json = d)
     r.raise_for_status()
     return r.json()
@@ -49,7 +58,30 @@ def get_batch(url, batch_id):
     r.raise_for_status()
     return r.json()
 
+def get_batch_timings(url, batch_id):
+    r = requests.get(url + '/batches/{}/timings'.format(batch_id))
+    r.raise_for_status()
+    return r.json()
+
+def get_batch_results(url, batch_id, after):
+    params = {}
+    if after:
+        params['after'] = after
+    r = requests.get(url + '/batches/{}/results'.format(batch_id), params = params, stream = True)
+    # close the connection even if the caller stops iterating early
+    with r:
+        r.raise_for_status()
+        # requests transparently decompresses the gzip Content-Encoding
+        for line in r.iter_lines():
+            if line:
+                yield json.loads(line)
+
+def cancel_batch(url, batch_id):
+    r = requests.post(url + '/batches/{}/cancel'.format(batch_id))
+    r.raise_for_status()
+    return r.json()
+
 def delete_batch(url, batch_id):
-    r = requests.delete(url + '/batches/{}'.format(batch_id))
+    r = requests.delete(url + '/batches/{}/delete'.format(batch_id))
     r.raise_for_status()
     return r.json()
@@ -63,6 +63,19 @@ class Batch(object):
     def status(self):
         return self.client._get_batch(self.id)
 
+    def cancel(self):
+        self.client._cancel_batch(self.id)
+
+    def delete(self):
+        self.client._delete_batch(self.id)
+
+    def timings(self):
+        return self.client._get_batch_timings(self.id)
+
+    def results(self, after=None):
+        # after is the id of the last result already received
+        return self.client._get_batch_results(self.id, after)
+
     def wait(self):
         i = 0
         while True:
@@ -136,6 +149,21 @@ class BatchClient(object):
     def _get_batch(self, batch_id):
         return api.get_batch(self.url, batch_id)
 
+    def _cancel_batch(self, batch_id):
+        api.cancel_batch(self.url, batch_id)
+
+    def _delete_batch(self, batch_id):
+        api.delete_batch(self.url, batch_id)
+
+    def _get_batch_timings(self, batch_id):
+        return api.get_batch_timings(self.url, batch_id)
+
+    def _get_batch_results(self, batch_id, after):
+        return api.get_batch_results(self.url, batch_id, after)
+
+    def _list_warm_pools(self):
+        return api.list_warm_pools(self.url)
+
     def list_jobs(self):
         jobs = api.list_jobs(self.url)
         return [Job(self, j['id'], j.get('attributes'), j) for j in jobs]
@@ -158,6 +186,8 @@ class BatchClient(object):
                    callback=None):
         return self._create_job(image, command, args, env, ports, resources, tolerations, volumes, attributes, None, callback)
 
-    def create_batch(self, attributes=None):
-        b = api.create_batch(self.url, attributes)
+    def create_batch(self, attributes=None, pack_size=None, pack_parallelism=None):
+        # with pack_size, up to pack_size compatible jobs with a command and
+        # no ports share one pod, running pack_parallelism at a time
+        b = api.create_batch(self.url, attributes, pack_size, pack_parallelism)
         return Batch(self, b['id'])
@@ -0,0 +1,110 @@
+import time
+import logging
+import threading
+from collections import deque
+
+log = logging.getLogger('batch')
+
+class EventPartition(object):
+    def __init__(self, merge):
+        self.merge = merge
+        self.cond = threading.Condition()
+        # entries are [name, event, enqueue time]
+        self.queue = deque()
+        # name -> queued MODIFIED entry that a newer MODIFIED may replace
+        self.pending_modified = {}
+        self.busy = False
+        self.processed = 0
+        self.coalesced = 0
+
+    def put(self, name, event):
+        with self.cond:
+            entry = self.pending_modified.get(name)
+            if event['type'] == 'MODIFIED' and entry:
+                # the handler only looks at the latest state of the pod
+                entry[1] = self.merge(entry[1], event)
+                self.coalesced = self.coalesced + 1
+                return
+
+            entry = [name, event, time.monotonic()]
+            self.queue.append(entry)
+            if event['type'] == 'MODIFIED':
+                self.pending_modified[name] = entry
+            else:
+                # later MODIFIED events must not jump ahead of this one
+                self.pending_modified.pop(name, None)
+            self.cond.notify()
+
+    def get(self):
+        with self.cond:
+            while not self.queue:
+                self.cond.wait()
+            name, event, _ = entry = self.queue.popleft()
+            if self.pending_modified.get(name) is entry:
+                del self.pending_modified[name]
+            self.busy = True
+            return event
+
+    def done(self):
+        with self.cond:
+            self.busy = False
+            self.processed = self.processed + 1
+            self.cond.notify_all()
+
+    def wait_idle(self):
+        with self.cond:
+            while self.queue or self.busy:
+                self.cond.wait()
+
+class EventDispatcher(object):
+    # hands events to n_workers threads, events for the same name always go
+    # to the same thread so they are handled in order.  merge(queued, new)
+    # returns the event that replaces a queued MODIFIED event, by default new
+
+    def __init__(self, handler, n_workers, merge=None):
+        if merge is None:
+            merge = lambda queued, new: new
+        self.handler = handler
+        self.partitions = [EventPartition(merge) for _ in range(n_workers)]
+
+    def start(self):
+        for partition in self.partitions:
+            t = threading.Thread(target=self._work, args=(partition,), daemon=True)
+            t.start()
+
+    def _work(self, partition):
+        while True:
+            event = partition.get()
+            try:
+                self.handler(event)
+            except:
+                log.exception('event handler failed on {} event'.format(event['type']))
+            finally:
+                partition.done()
+
+    def put(self, name, event):
+        self.partitions[hash(name) % len(self.partitions)].put(name, event)
+
+    def wait_idle(self):
+        for partition in self.partitions:
+            partition.wait_idle()
+
+    def stats(self):
+        now = time.monotonic()
+        depth = 0
+        lag = 0
+        processed = 0
+        coalesced = 0
+        for partition in self.partitions:
+            with partition.cond:
+                depth = depth + len(partition.queue)
+                if partition.queue:
+                    lag = max(lag, now - partition.queue[0][2])
+                processed = processed + partition.processed
+                coalesced = coalesced + partition.coalesced
+        return {
+            'depth': depth,
+            'lag_secs': lag,
+            'processed': processed,
+            'coalesced': coalesced
+        }
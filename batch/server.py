@@ -2,13 +2,23 @@ import sys
 import os
 import time
 import random
-from collections import Counter
+import subprocess
+from collections import Counter, deque
+from functools import partial
 import logging
 import threading
-from flask import Flask, request, jsonify, abort, url_for
+import json
+import zlib
+import shlex
+import uuid
+import re
+from decimal import Decimal
+from flask import Flask, Response, request, jsonify, abort, url_for
 import kubernetes as kube
+import kubernetes.stream
 import cerberus
 import requests
+from events import EventDispatcher
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger('batch')
@@ -18,17 +28,603 @@ if 'BATCH_USE_KUBE_CONFIG' in os.environ:
 else:
     kube.config.load_incluster_config()
 v1 = kube.client.CoreV1Api()
+# exec replaces the request method of its api client while it runs, so it
+# gets a client of its own and one exec at a time
+exec_v1 = kube.client.CoreV1Api(kube.client.ApiClient())
+exec_lock = threading.Lock()
 
 counter = 0
+counter_lock = threading.Lock()
 def next_id():
     global counter
 
-    counter = counter + 1
-    return counter
+    with counter_lock:
+        counter = counter + 1
+        return counter
 
 pod_name_job = {}
 job_id_job = {}
 
+# lifecycle phases as (name, start timestamp, end timestamp), in order
+JOB_PHASES = [
+    ('pod_creation', 'created', 'pod_created'),
+    ('warm_pool_queueing', 'created', 'dispatched'),
+    ('scheduling', 'pod_created', 'scheduled'),
+    ('container_startup', 'scheduled', 'running'),
+    ('run', 'running', 'terminated'),
+    ('log_fetch', 'terminated', 'log_fetched'),
+    ('callback', 'log_fetched', 'callback_complete'),
+    ('total', 'created', 'complete')
+]
+
+# timestamps that belong to the current pod and are discarded if it is recreated
+POD_TIMESTAMPS = ['pod_created', 'scheduled', 'running', 'terminated']
+
+EVENT_WORKERS = int(os.environ.get('BATCH_EVENT_WORKERS', 8))
+
+# a partially filled pack is started once its oldest job has waited this long
+PACK_MAX_WAIT_SECS = 2
+PACK_POLL_SECS = 0.5
+
+# guards the pending packs of all batches
+pack_lock = threading.Lock()
+
+def is_packable(pod_spec):
+    if len(pod_spec.containers) != 1:
+        return False
+    container = pod_spec.containers[0]
+    # jobs listening on ports would collide when run in the same pod
+    return bool(container.command) and not container.ports
+
+def pack_key(pod_spec):
+    # jobs with equal keys differ only in command, args and plain env values
+    spec = v1.api_client.sanitize_for_serialization(pod_spec)
+    container = spec['containers'][0]
+    container.pop('command', None)
+    container.pop('args', None)
+    container['env'] = [e for e in container.get('env', []) if 'valueFrom' in e]
+    return json.dumps(spec, sort_keys=True)
+
+QUANTITY_RE = re.compile('^([0-9.]+)(.*)$')
+
+def scale_quantity(quantity, factor):
+    # multiplies a kube resource quantity like '500m' or '1.5Gi'
+    m = QUANTITY_RE.match(str(quantity))
+    if not m:
+        raise ValueError('cannot scale resource quantity {}'.format(quantity))
+    return str(Decimal(m.group(1)) * factor) + m.group(2)
+
+def scale_resources(resources, factor):
+    for kind in ['requests', 'limits']:
+        if resources.get(kind):
+            resources[kind] = {
+                name: scale_quantity(q, factor) for name, q in resources[kind].items()
+            }
+
+def job_shell_command(container):
+    words = []
+    if container.env:
+        for e in container.env:
+            if e.value is not None:
+                words.append('export {}={};'.format(e.name, shlex.quote(e.value)))
+    words.append('exec')
+    words.extend(shlex.quote(a) for a in container.command + (container.args or []))
+    return ' '.join(words)
+
+def pack_dir(token):
+    return '/tmp/batch-pack-{}'.format(token)
+
+def pack_script(jobs, parallelism, token):
+    # runs the jobs parallelism at a time and frames each job's log and exit
+    # code between token markers on stdout, see parse_pack_log.  a job is
+    # skipped if its cancel marker exists when its chunk starts, see
+    # pack_cancel_command
+    lines = ['d={}'.format(pack_dir(token)), 'mkdir -p "$d"']
+    for i in range(0, len(jobs), parallelism):
+        chunk = jobs[i:i + parallelism]
+        for j in chunk:
+            lines.append(
+                'if [ ! -e "$d/{id}.cancelled" ]; then '
+                '{{ ({cmd}) > "$d/{id}.log" 2>&1 & echo $! > "$d/{id}.pid"; '
+                'wait $!; echo $? > "$d/{id}.exit_code"; }} 2> /dev/null & fi'.format(
+                    id = j.id, cmd = job_shell_command(j.pod_template.spec.containers[0])))
+        lines.append('wait')
+        for j in chunk:
+            # skipped jobs report nothing
+            lines.append('if [ -e "$d/{}.exit_code" ]; then'.format(j.id))
+            lines.append("printf '%s begin %s\\n' {} {}".format(token, j.id))
+            lines.append('cat "$d/{}.log"'.format(j.id))
+            lines.append("printf '%s end %s %s\\n' {} {} \"$(cat \"$d/{}.exit_code\")\"".format(
+                token, j.id, j.id))
+            lines.append('fi')
+    lines.append('exit 0')
+    return '\n'.join(lines) + '\n'
+
+def pack_cancel_command(token, job_id):
+    # marks the job cancelled so the runner skips it, and kills it if running
+    return (
+        'd={d}; mkdir -p "$d"; touch "$d/{id}.cancelled"; '
+        'if [ -e "$d/{id}.pid" ]; then kill $(cat "$d/{id}.pid"); fi; true'.format(
+            d = pack_dir(token), id = job_id))
+
+def parse_pack_log(pack_log, token):
+    # returns {job_id: (exit_code, log)}.  jobs whose markers are missing or
+    # malformed, for example because the log was truncated or the runner could
+    # not write the exit code, are left out
+    results = {}
+    begin = '{} begin '.format(token)
+    pos = pack_log.find(begin)
+    while pos >= 0:
+        begin_end = pack_log.find('\n', pos)
+        if begin_end < 0:
+            break
+        next_pos = begin_end + 1
+        try:
+            job_id = int(pack_log[pos + len(begin):begin_end])
+            end = '{} end {} '.format(token, job_id)
+            end_start = pack_log.find(end, begin_end + 1)
+            if end_start >= 0:
+                end_end = pack_log.find('\n', end_start)
+                if end_end >= 0:
+                    next_pos = end_end + 1
+                    exit_code = int(pack_log[end_start + len(end):end_end])
+                    results[job_id] = (exit_code, pack_log[begin_end + 1:end_start])
+        except ValueError:
+            pass
+        pos = pack_log.find(begin, next_pos)
+    return results
+
+# warm pool mode: 'kube' runs workers in pods, 'local' in local processes
+WARM_POOL = os.environ.get('BATCH_WARM_POOL')
+WARM_POOL_URL = os.environ.get(
+    'BATCH_WARM_POOL_URL',
+    'http://127.0.0.1:5000' if WARM_POOL == 'local' else 'http://batch')
+WARM_POOL_MIN_WORKERS = int(os.environ.get('BATCH_WARM_POOL_MIN_WORKERS', 1))
+WARM_POOL_MAX_WORKERS = int(os.environ.get('BATCH_WARM_POOL_MAX_WORKERS', 8))
+WARM_POOL_IDLE_SECS = float(os.environ.get('BATCH_WARM_POOL_IDLE_SECS', 60))
+WARM_POOL_POLL_SECS = 1
+# an idle worker's request for a job waits this long for one to be submitted
+WORKER_WAIT_SECS = 10
+# kube workers run worker.py in the job's image, so only images known to have
+# python3 use the warm pool.  local workers run on the server's python
+WARM_POOL_IMAGES = set(i for i in os.environ.get('BATCH_WARM_POOL_IMAGES', '').split(',') if i)
+# a pool whose workers exit this many times before asking for a job is given
+# up on, its jobs get pods of their own
+WARM_POOL_MAX_STARTUP_FAILURES = 3
+
+WORKER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'worker.py')
+
+# guards warm_pools, worker_id_worker and the state of their contents
+warm_pool_lock = threading.Lock()
+
+# pack key -> WarmPool
+warm_pools = {}
+worker_id_worker = {}
+# pack keys of pools whose workers failed to start
+failed_warm_pool_keys = set()
+
+def uses_warm_pool(pod_spec):
+    if not WARM_POOL or not is_packable(pod_spec):
+        return False
+    return WARM_POOL == 'local' or pod_spec.containers[0].image in WARM_POOL_IMAGES
+
+class Worker(object):
+    # created under warm_pool_lock, start and stop make pod or process calls
+    # that can block so they run after it is released
+
+    def __init__(self, pool):
+        self.id = next_id()
+        worker_id_worker[self.id] = self
+        self.pool = pool
+        self.job = None
+        self.idle_since = time.monotonic()
+        # set once the worker asks for a job, i.e. it started successfully
+        self.polled = False
+        # set when the pool removes the worker, possibly before it started
+        self.stopped = False
+
+    def start(self):
+        try:
+            self._start()
+        except:
+            log.exception('failed to start worker {}'.format(self.id))
+            with warm_pool_lock:
+                actions = self.pool.worker_exited(self)
+            run_warm_pool_actions(actions)
+
+    def is_idle(self):
+        return self.job is None
+
+    def has_exited(self):
+        return False
+
+    def to_json(self):
+        return {
+            'id': self.id,
+            'job': self.job.id if self.job else None
+        }
+
+class KubeWorker(Worker):
+    def __init__(self, pool):
+        super().__init__(pool)
+        self._pod_name = None
+
+    def _start(self):
+        spec = json.loads(self.pool.key)
+        container = spec['containers'][0]
+        with open(WORKER_PATH) as f:
+            container['command'] = ['python3', '-c', f.read(), WARM_POOL_URL, str(self.id)]
+        pod_spec = v1.api_client._ApiClient__deserialize(spec, kube.client.V1PodSpec)
+
+        pod = v1.create_namespaced_pod(
+            'default',
+            kube.client.V1Pod(
+                metadata = kube.client.V1ObjectMeta(generate_name = 'worker-{}-'.format(self.id)),
+                spec = pod_spec))
+        with warm_pool_lock:
+            self._pod_name = pod.metadata.name
+            pod_name_job[self._pod_name] = self
+            stopped = self.stopped
+
+        log.info('created pod name: {} for worker {}'.format(pod.metadata.name, self.id))
+
+        # the pool removed the worker while its pod was being created
+        if stopped:
+            self.stop()
+
+    def to_json(self):
+        result = super().to_json()
+        result['pod_name'] = self._pod_name
+        return result
+
+    def stop(self):
+        with warm_pool_lock:
+            pod_name = self._pod_name
+            self._pod_name = None
+        if pod_name:
+            pod_name_job.pop(pod_name, None)
+            try:
+                v1.delete_namespaced_pod(pod_name, 'default', kube.client.V1DeleteOptions())
+            except kube.client.rest.ApiException as e:
+                if e.status == 404:
+                    pass
+                else:
+                    raise
+
+    # kube_event_loop treats worker pods like job pods
+
+    def is_complete(self):
+        return False
+
+    def mark_timestamp(self, name, t=None):
+        pass
+
+    def mark_unscheduled(self):
+        with warm_pool_lock:
+            pod_name = self._pod_name
+            self._pod_name = None
+            actions = self.pool.worker_exited(self)
+        if pod_name:
+            pod_name_job.pop(pod_name, None)
+        run_warm_pool_actions(actions)
+
+    def mark_complete(self, pod):
+        self.mark_unscheduled()
+
+class LocalWorker(Worker):
+    def __init__(self, pool):
+        super().__init__(pool)
+        self._process = None
+
+    def _start(self):
+        process = subprocess.Popen(
+            [sys.executable, WORKER_PATH, WARM_POOL_URL, str(self.id)])
+        with warm_pool_lock:
+            self._process = process
+            stopped = self.stopped
+        log.info('started process {} for worker {}'.format(process.pid, self.id))
+
+        if stopped:
+            self.stop()
+
+    def stop(self):
+        with warm_pool_lock:
+            process = self._process
+        if process:
+            process.terminate()
+            process.wait()
+
+    def has_exited(self):
+        return self._process is not None and self._process.poll() is not None
+
+    def to_json(self):
+        result = super().to_json()
+        result['pid'] = self._process.pid if self._process else None
+        return result
+
+def create_job_pod(job):
+    # for jobs of a failed warm pool, unless cancelled in the meantime
+    if not job.is_complete():
+        job._create_pod()
+
+def run_warm_pool_actions(actions):
+    for action in actions:
+        action()
+
+class WarmPool(object):
+    # all methods must be called with warm_pool_lock held. starting and
+    # stopping workers and creating pods can block, so methods that need them
+    # return a list of actions for the caller to run with run_warm_pool_actions
+    # after releasing the lock
+
+    def __init__(self, key):
+        self.key = key
+        self.queue = deque()
+        self.workers = {}
+        self.startup_failures = 0
+        self.failed = False
+        # idle workers wait on this for jobs
+        self.cond = threading.Condition(warm_pool_lock)
+
+    def _add_worker(self):
+        if WARM_POOL == 'local':
+            worker = LocalWorker(self)
+        else:
+            worker = KubeWorker(self)
+        self.workers[worker.id] = worker
+        return worker.start
+
+    def _remove_worker(self, worker):
+        del self.workers[worker.id]
+        del worker_id_worker[worker.id]
+        worker.stopped = True
+        # a removed worker waiting for a job should stop waiting
+        self.cond.notify_all()
+        return worker.stop
+
+    def n_idle(self):
+        return len([w for w in self.workers.values() if w.is_idle()])
+
+    def submit(self, job):
+        job._warm_pool = self
+        self.queue.append(job)
+        self.cond.notify()
+        if self.n_idle() < len(self.queue) and len(self.workers) < WARM_POOL_MAX_WORKERS:
+            return [self._add_worker()]
+        return []
+
+    def next_job(self, worker):
+        worker.polled = True
+        while self.queue:
+            job = self.queue.popleft()
+            if job.is_complete():
+                continue
+            worker.job = job
+            job._worker = worker
+            job.mark_timestamp('dispatched')
+            job.mark_timestamp('running')
+            log.info('dispatched job {} to worker {}'.format(job.id, worker.id))
+            return job
+        return None
+
+    def job_done(self, worker):
+        job = worker.job
+        worker.job = None
+        worker.idle_since = time.monotonic()
+        job._worker = None
+        job._warm_pool = None
+        return job
+
+    def remove_job(self, job):
+        actions = []
+        if job._worker:
+            # the only way to stop a running job is to stop its worker
+            actions.append(self._remove_worker(job._worker))
+            job._worker = None
+        else:
+            self.queue.remove(job)
+        job._warm_pool = None
+        return actions
+
+    def worker_exited(self, worker):
+        if worker.id not in self.workers:
+            return []
+        log.warn('worker {} exited'.format(worker.id))
+        actions = [self._remove_worker(worker)]
+        job = worker.job
+        if job and not job.is_complete():
+            job._worker = None
+            self.queue.appendleft(job)
+            self.cond.notify()
+
+        if not worker.polled:
+            self.startup_failures = self.startup_failures + 1
+            if self.startup_failures >= WARM_POOL_MAX_STARTUP_FAILURES:
+                actions.extend(self._fail())
+        return actions
+
+    def _fail(self):
+        log.error('{} warm pool workers failed to start, running jobs of this pool in their own pods: {}'.format(
+            self.startup_failures, self.key))
+        self.failed = True
+        del warm_pools[self.key]
+        failed_warm_pool_keys.add(self.key)
+
+        actions = []
+        jobs = list(self.queue)
+        self.queue.clear()
+        for worker in list(self.workers.values()):
+            if worker.job:
+                jobs.append(worker.job)
+            actions.append(self._remove_worker(worker))
+
+        for job in jobs:
+            job._worker = None
+            job._warm_pool = None
+            actions.append(partial(create_job_pod, job))
+        return actions
+
+    def scale(self, idle_before):
+        actions = []
+        for worker in list(self.workers.values()):
+            if worker.has_exited():
+                actions.extend(self.worker_exited(worker))
+
+        if self.failed:
+            return actions
+
+        n_start = min(len(self.queue) - self.n_idle(), WARM_POOL_MAX_WORKERS - len(self.workers))
+        for _ in range(n_start):
+            actions.append(self._add_worker())
+
+        for worker in list(self.workers.values()):
+            if len(self.workers) <= WARM_POOL_MIN_WORKERS:
+                break
+            if worker.is_idle() and worker.idle_since < idle_before:
+                log.info('stopping idle worker {}'.format(worker.id))
+                actions.append(self._remove_worker(worker))
+        return actions
+
+    def to_json(self):
+        return {
+            'image': json.loads(self.key)['containers'][0]['image'],
+            'queued': len(self.queue),
+            'startup_failures': self.startup_failures,
+            'workers': [w.to_json() for w in self.workers.values()]
+        }
+
+def submit_to_warm_pool(job):
+    key = pack_key(job.pod_template.spec)
+    with warm_pool_lock:
+        if key not in failed_warm_pool_keys:
+            pool = warm_pools.get(key)
+            if not pool:
+                pool = WarmPool(key)
+                warm_pools[key] = pool
+            actions = pool.submit(job)
+        else:
+            actions = [job._create_pod]
+    run_warm_pool_actions(actions)
+
+class JobPack(object):
+    def _create_pod(self):
+        assert not self._pod_name
+
+        spec = json.loads(self.key)
+        container = spec['containers'][0]
+        container['command'] = ['/bin/sh', '-c', pack_script(self.jobs, self.parallelism, self.token)]
+        # each job asked for its resources, and up to parallelism run at once
+        if container.get('resources'):
+            scale_resources(container['resources'], min(self.parallelism, len(self.jobs)))
+        pod_spec = v1.api_client._ApiClient__deserialize(spec, kube.client.V1PodSpec)
+
+        pod = v1.create_namespaced_pod(
+            'default',
+            kube.client.V1Pod(
+                metadata = kube.client.V1ObjectMeta(generate_name = 'pack-{}-'.format(self.id),
+                                                    labels = {'batch_id': str(self.batch_id)}),
+                spec = pod_spec))
+        self._pod_name = pod.metadata.name
+        pod_name_job[self._pod_name] = self
+        self.mark_timestamp('pod_created')
+
+        log.info('created pod name: {} for pack {} of jobs {}'.format(
+            self._pod_name, self.id, [j.id for j in self.jobs]))
+
+    def _delete_pod(self):
+        if self._pod_name:
+            try:
+                v1.delete_namespaced_pod(self._pod_name, 'default', kube.client.V1DeleteOptions())
+            except kube.client.rest.ApiException as e:
+                if e.status == 404:
+                    pass
+                else:
+                    raise
+            self._forget_pod()
+
+    def _forget_pod(self):
+        # Batch.cancel and the kube event threads may both forget the pod
+        pod_name = self._pod_name
+        if pod_name:
+            pod_name_job.pop(pod_name, None)
+            self._pod_name = None
+
+    def __init__(self, batch_id, key, parallelism):
+        self.id = next_id()
+        self.batch_id = batch_id
+        self.key = key
+        self.parallelism = parallelism
+        self.token = uuid.uuid4().hex
+        self.created = time.monotonic()
+        self.jobs = []
+        self._pod_name = None
+
+    def add(self, job):
+        assert not self._pod_name
+        self.jobs.append(job)
+        job._pack = self
+
+    def remove(self, job):
+        self.jobs.remove(job)
+        job._pack = None
+        if not self.jobs:
+            self._delete_pod()
+
+    def cancel_in_pod(self, job):
+        # stop a removed job in a running pack so later jobs don't wait on it
+        pod_name = self._pod_name
+        if not pod_name:
+            return
+        try:
+            with exec_lock:
+                kube.stream.stream(
+                    exec_v1.connect_get_namespaced_pod_exec, pod_name, 'default',
+                    command = ['/bin/sh', '-c', pack_cancel_command(self.token, job.id)],
+                    stderr = True, stdin = False, stdout = True, tty = False)
+        except kube.client.rest.ApiException as e:
+            # e.g. the pod already finished, its result for the job is ignored
+            log.warn('could not cancel job {} in pod {}: {}'.format(job.id, pod_name, e))
+
+    def start(self):
+        if self.jobs:
+            self._create_pod()
+
+    def is_complete(self):
+        return all(j.is_complete() for j in self.jobs)
+
+    def mark_timestamp(self, name, t=None):
+        if t is None:
+            t = time.monotonic()
+        for j in self.jobs:
+            j.mark_timestamp(name, t)
+
+    def mark_unscheduled(self):
+        self._forget_pod()
+        for j in self.jobs:
+            j._reset_pod_timestamps()
+        self._create_pod()
+
+    def mark_complete(self, pod):
+        pod_exit_code = pod.status.container_statuses[0].state.terminated.exit_code
+        self.mark_timestamp('terminated')
+        pack_log = v1.read_namespaced_pod_log(pod.metadata.name, 'default')
+        self.mark_timestamp('log_fetched')
+
+        results = parse_pack_log(pack_log, self.token)
+        for j in self.jobs:
+            if j.is_complete():
+                continue
+            if j.id in results:
+                exit_code, job_log = results[j.id]
+            else:
+                # the runner always exits 0, so the pod's exit code says
+                # nothing about this job
+                message = 'pack {} exited with {} without reporting a result for job {}'.format(
+                    self.id, pod_exit_code, j.id)
+                log.warn(message)
+                exit_code, job_log = -1, message + '\n'
+            j._set_result(exit_code, job_log)
+
 class Job(object):
     def _create_pod(self):
         assert not self._pod_name
@@ -36,6 +632,7 @@ class Job(object):
         pod = v1.create_namespaced_pod('default', self.pod_template)
         self._pod_name = pod.metadata.name
         pod_name_job[self._pod_name] = self
+        self.mark_timestamp('pod_created')
 
         log.info('created pod name: {} for job {}'.format(self._pod_name, self.id))
 
@@ -48,71 +645,152 @@ class Job(object):
                     pass
                 else:
                     raise
-            del pod_name_job[self._pod_name]
+            self._forget_pod()
+
+    def _forget_pod(self):
+        # Batch.cancel and the kube event threads may both forget the pod
+        pod_name = self._pod_name
+        if pod_name:
+            pod_name_job.pop(pod_name, None)
             self._pod_name = None
 
     def __init__(self, pod_spec, batch_id, attributes, callback):
         self.id = next_id()
-        job_id_job[self.id] = self
 
         self.batch_id = batch_id
         if batch_id:
             batch = batch_id_batch[batch_id]
-            batch.jobs.append(self)
 
         self.attributes = attributes
         self.callback = callback
 
+        # monotonic time at which each lifecycle phase was first observed
+        self._timestamps = {}
+        self.mark_timestamp('created')
+
+        labels = {}
+        if batch_id:
+            labels['batch_id'] = str(batch_id)
+
         self.pod_template = kube.client.V1Pod(
-            metadata = kube.client.V1ObjectMeta(generate_name = 'job-{}-'.format(self.id)),
+            metadata = kube.client.V1ObjectMeta(generate_name = 'job-{}-'.format(self.id),
+                                                labels = labels),
             spec = pod_spec)
 
         self._pod_name = None
+        self._pack = None
+        self._warm_pool = None
+        self._worker = None
 
         self._state = 'Created'
+        # guards _state, exit_code and log
+        self._state_lock = threading.RLock()
         log.info('created job {}'.format(self.id))
 
-        self._create_pod()
+        # request threads may read the job as soon as it is registered, so
+        # only register it once it is fully built
+        job_id_job[self.id] = self
+        if batch_id:
+            batch.jobs.append(self)
+
+        if batch_id and batch.pack_size and is_packable(pod_spec):
+            batch.add_to_pack(self)
+        elif uses_warm_pool(pod_spec):
+            submit_to_warm_pool(self)
+        else:
+            self._create_pod()
 
     def set_state(self, new_state):
-        if self._state != new_state:
-            log.info('job {} changed state: {} -> {}'.format(
-                self.id,
-                self._state,
-                new_state))
-            self._state = new_state
+        with self._state_lock:
+            # a Complete or Cancelled job stays that way, e.g. a result that
+            # arrives after the job was cancelled is ignored
+            if self._state != new_state and not self.is_complete():
+                log.info('job {} changed state: {} -> {}'.format(
+                    self.id,
+                    self._state,
+                    new_state))
+                self._state = new_state
+                if self.is_complete():
+                    self.mark_timestamp('complete')
+
+    def mark_timestamp(self, name, t=None):
+        if name not in self._timestamps:
+            if t is None:
+                t = time.monotonic()
+            self._timestamps[name] = t
+
+    def phase_durations(self):
+        timestamps = self._timestamps.copy()
+        durations = {}
+        for phase, start, end in JOB_PHASES:
+            if start in timestamps and end in timestamps:
+                durations[phase] = timestamps[end] - timestamps[start]
+        return durations
 
     def cancel(self):
         if self.is_complete():
             return
         self._delete_pod()
+        self._leave_pack()
+        self._leave_warm_pool()
         self.set_state('Cancelled')
 
+    def _leave_pack(self):
+        pack = self._pack
+        if pack:
+            with pack_lock:
+                pack.remove(self)
+            pack.cancel_in_pod(self)
+
+    def _leave_warm_pool(self):
+        with warm_pool_lock:
+            actions = self._warm_pool.remove_job(self) if self._warm_pool else []
+        run_warm_pool_actions(actions)
+
     def delete(self):
         # remove from structures
-        del job_id_job[self.id]
-        if self.batch_id:
-            batch = batch_id_batch[batch_id]
-            batch.remove(self)
+        job_id_job.pop(self.id, None)
+        batch = batch_id_batch.get(self.batch_id)
+        if batch:
+            batch.jobs.remove(self)
 
         self._delete_pod()
+        self._leave_pack()
+        self._leave_warm_pool()
 
     def is_complete(self):
         return self._state == 'Complete' or self._state == 'Cancelled'
 
+    def _reset_pod_timestamps(self):
+        for name in POD_TIMESTAMPS:
+            self._timestamps.pop(name, None)
+
     def mark_unscheduled(self):
-        if self._pod_name:
-            del pod_name_job[self._pod_name]
-            self._pod_name = None
+        self._forget_pod()
+        if self.is_complete():
+            return
+        self._reset_pod_timestamps()
         self._create_pod()
 
     def mark_complete(self, pod):
-        self.exit_code = pod.status.container_statuses[0].state.terminated.exit_code
-        self.log = v1.read_namespaced_pod_log(pod.metadata.name, 'default')
+        exit_code = pod.status.container_statuses[0].state.terminated.exit_code
+        self.mark_timestamp('terminated')
+        pod_log = v1.read_namespaced_pod_log(pod.metadata.name, 'default')
+        self.mark_timestamp('log_fetched')
+        self._set_result(exit_code, pod_log)
+
+    def _set_result(self, exit_code, job_log):
+        with self._state_lock:
+            if self.is_complete():
+                log.info('job {} already {}, ignoring exit_code {}'.format(
+                    self.id, self._state, exit_code))
+                return
+            self.exit_code = exit_code
+            self.log = job_log
 
-        log.info('job {} complete, exit_code {}'.format(
-            self.id, self.exit_code))
-        self.set_state('Complete')
+            log.info('job {} complete, exit_code {}'.format(
+                self.id, self.exit_code))
+            self.set_state('Complete')
 
         if self.callback:
             try:
@@ -120,11 +798,17 @@ class Job(object):
             except requests.exceptions.RequestException as re:
                 id = self.id
                 log.warn(f'callback for job {id} failed due to an error, I will not retry. Error: {re}')
+            self.mark_timestamp('callback_complete')
 
     def to_json(self):
+        # report timestamps in seconds relative to job creation.  kube event
+        # threads update _timestamps concurrently, so work on a copy
+        timestamps = self._timestamps.copy()
+        created = timestamps['created']
         result = {
             'id': self.id,
-            'state': self._state
+            'state': self._state,
+            'timestamps': {name: t - created for name, t in timestamps.items()}
         }
         if self._state == 'Complete':
             result['exit_code'] = self.exit_code
@@ -133,6 +817,18 @@ class Job(object):
             result['attributes'] = self.attributes
         return result
 
+    def to_result_json(self):
+        result = {
+            'id': self.id,
+            'state': self._state,
+            'log_path': '/jobs/{}/log'.format(self.id)
+        }
+        if self._state == 'Complete':
+            result['exit_code'] = self.exit_code
+        if self.attributes:
+            result['attributes'] = self.attributes
+        return result
+
 app = Flask('batch')
 
 @app.route('/jobs/create', methods=['POST'])
@@ -173,7 +869,8 @@ def create_job():
 
 @app.route('/jobs', methods=['GET'])
 def get_job_list():
-    return jsonify([job.to_json() for _, job in job_id_job.items()])
+    # other request threads add and remove jobs, iterate over a snapshot
+    return jsonify([job.to_json() for job in job_id_job.copy().values()])
 
 @app.route('/jobs/<int:job_id>', methods=['GET'])
 def get_job(job_id):
@@ -182,6 +879,15 @@ def get_job(job_id):
         abort(404)
     return jsonify(job.to_json())
 
+@app.route('/jobs/<int:job_id>/log', methods=['GET'])
+def get_job_log(job_id):
+    job = job_id_job.get(job_id)
+    if not job:
+        abort(404)
+    if job._state != 'Complete':
+        abort(404, 'job {} has no log, state is {}'.format(job_id, job._state))
+    return jsonify({'log': job.log})
+
 @app.route('/jobs/<int:job_id>/delete', methods=['DELETE'])
 def delete_job(job_id):
     job = job_id_job.get(job_id)
@@ -201,21 +907,78 @@ def cancel_job(job_id):
 batch_id_batch = {}
 
 class Batch(object):
-    def __init__(self, attributes):
+    def __init__(self, attributes, pack_size, pack_parallelism):
         self.attributes = attributes
         self.id = next_id()
-        batch_id_batch[self.id] = self
         self.jobs = []
 
+        self.pack_size = pack_size
+        self.pack_parallelism = pack_parallelism
+        # pack key -> JobPack waiting to be filled
+        self._pending_packs = {}
+
+        batch_id_batch[self.id] = self
+
+    def add_to_pack(self, job):
+        key = pack_key(job.pod_template.spec)
+        with pack_lock:
+            pack = self._pending_packs.get(key)
+            if not pack:
+                pack = JobPack(self.id, key, self.pack_parallelism)
+                self._pending_packs[key] = pack
+            pack.add(job)
+            if len(pack.jobs) >= self.pack_size:
+                del self._pending_packs[key]
+                pack.start()
+
+    def start_packs(self, created_before):
+        # caller must hold pack_lock
+        for key, pack in list(self._pending_packs.items()):
+            if pack.created <= created_before:
+                del self._pending_packs[key]
+                pack.start()
+
+    def _delete_pods(self):
+        with pack_lock:
+            self._pending_packs = {}
+
+        # forget the pods first so the kube event loop ignores their deletion
+        for j in self.jobs:
+            j._forget_pod()
+            if j._pack:
+                j._pack._forget_pod()
+        v1.delete_collection_namespaced_pod(
+            'default', label_selector = 'batch_id={}'.format(self.id))
+
+    def cancel(self):
+        self._delete_pods()
+        # take the lock once for the whole batch, and stop workers after
+        # releasing it
+        actions = []
+        with warm_pool_lock:
+            for j in self.jobs:
+                if not j.is_complete() and j._warm_pool:
+                    actions.extend(j._warm_pool.remove_job(j))
+        run_warm_pool_actions(actions)
+
+        n_cancelled = 0
+        for j in self.jobs:
+            if not j.is_complete():
+                j.set_state('Cancelled')
+                n_cancelled = n_cancelled + 1
+        log.info('batch {} cancelled {} jobs'.format(self.id, n_cancelled))
+
     def delete(self):
-        del batch_id_batch[self.id]
+        self.cancel()
+        batch_id_batch.pop(self.id, None)
         for j in self.jobs:
             assert j.batch_id == self.id
-            j.batch_id = None
+            job_id_job.pop(j.id, None)
+        log.info('batch {} deleted with {} jobs'.format(self.id, len(self.jobs)))
 
     def to_json(self):
         state_count = Counter([j._state for j in self.jobs])
-        return {
+        result = {
             'id': self.id,
             'jobs': {
                 'Created': state_count.get('Created', 0),
@@ -224,6 +987,10 @@ class Batch(object):
             },
             'attributes': self.attributes
         }
+        if self.pack_size:
+            result['pack_size'] = self.pack_size
+            result['pack_parallelism'] = self.pack_parallelism
+        return result
 
 @app.route('/batches/create', methods=['POST'])
 def create_batch():
@@ -234,13 +1001,17 @@ def create_batch():
             'type': 'dict',
             'keyschema': {'type': 'string'},
             'valueschema': {'type': 'string'}
-        }
+        },
+        'pack_size': {'type': 'integer', 'min': 1},
+        'pack_parallelism': {'type': 'integer', 'min': 1}
     }
     v = cerberus.Validator(schema)
     if (not v.validate(parameters)):
         abort(404, 'invalid request: {}'.format(v.errors))
 
-    batch = Batch(parameters.get('attributes'))
+    batch = Batch(parameters.get('attributes'),
+                  parameters.get('pack_size'),
+                  parameters.get('pack_parallelism', 1))
     return jsonify(batch.to_json())
 
 @app.route('/batches/<int:batch_id>', methods=['GET'])
@@ -250,6 +1021,80 @@ def get_batch(batch_id):
         abort(404)
     return jsonify(batch.to_json())
 
+# flush the compressor every this many jobs so clients see results as they
+# are generated rather than when the whole batch has been serialized
+RESULTS_FLUSH_INTERVAL = 1000
+
+def generate_batch_results(jobs):
+    compressor = zlib.compressobj(wbits = 16 + zlib.MAX_WBITS)
+
+    for i, j in enumerate(jobs, 1):
+        line = json.dumps(j.to_result_json()) + '\n'
+        chunk = compressor.compress(line.encode('utf-8'))
+        if i % RESULTS_FLUSH_INTERVAL == 0:
+            chunk = chunk + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if chunk:
+            yield chunk
+    yield compressor.flush()
+
+@app.route('/batches/<int:batch_id>/results', methods=['GET'])
+def get_batch_results(batch_id):
+    batch = batch_id_batch.get(batch_id)
+    if not batch:
+        abort(404)
+
+    # results are streamed in job id order, a client resumes an interrupted
+    # download by passing the id of the last result it received as after.
+    # the set of jobs is a snapshot taken when the request starts: jobs
+    # created later are picked up by the next resumed request, and deleting a
+    # job never shifts the position of the others.  each job's state is read
+    # when its line is generated.
+    after = request.args.get('after', 0, type=int)
+    jobs = sorted((j for j in batch.jobs if j.id > after), key = lambda j: j.id)
+
+    return Response(
+        generate_batch_results(jobs),
+        mimetype='application/x-ndjson',
+        headers={'Content-Encoding': 'gzip'})
+
+def percentile(sorted_values, p):
+    # nearest-rank percentile
+    i = max(0, -(-len(sorted_values) * p // 100) - 1)
+    return sorted_values[int(i)]
+
+@app.route('/batches/<int:batch_id>/timings', methods=['GET'])
+def get_batch_timings(batch_id):
+    batch = batch_id_batch.get(batch_id)
+    if not batch:
+        abort(404)
+
+    phase_durations = {phase: [] for phase, _, _ in JOB_PHASES}
+    for j in batch.jobs:
+        for phase, duration in j.phase_durations().items():
+            phase_durations[phase].append(duration)
+
+    result = {}
+    for phase, durations in phase_durations.items():
+        if not durations:
+            continue
+        durations.sort()
+        result[phase] = {
+            'count': len(durations),
+            'p50': percentile(durations, 50),
+            'p90': percentile(durations, 90),
+            'p99': percentile(durations, 99),
+            'max': durations[-1]
+        }
+    return jsonify(result)
+
+@app.route('/batches/<int:batch_id>/cancel', methods=['POST'])
+def cancel_batch(batch_id):
+    batch = batch_id_batch.get(batch_id)
+    if not batch:
+        abort(404)
+    batch.cancel()
+    return jsonify({})
+
 @app.route('/batches/<int:batch_id>/delete', methods=['DELETE'])
 def delete_batch(batch_id):
     batch = batch_id_batch.get(batch_id)
@@ -258,6 +1103,84 @@ def delete_batch(batch_id):
     batch.delete()
     return jsonify({})
 
+@app.route('/workers/<int:worker_id>/next', methods=['POST'])
+def next_worker_job(worker_id):
+    # long poll, so a job submitted to an idle pool starts right away
+    deadline = time.monotonic() + WORKER_WAIT_SECS
+    with warm_pool_lock:
+        while True:
+            worker = worker_id_worker.get(worker_id)
+            if not worker:
+                abort(404)
+            job = worker.pool.next_job(worker)
+            if job:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return jsonify({})
+            worker.pool.cond.wait(remaining)
+
+        container = job.pod_template.spec.containers[0]
+        env = {}
+        if container.env:
+            for e in container.env:
+                if e.value is not None:
+                    env[e.name] = e.value
+        return jsonify({
+            'id': job.id,
+            'command': container.command + (container.args or []),
+            'env': env
+        })
+
+@app.route('/workers/<int:worker_id>/jobs/<int:job_id>/complete', methods=['POST'])
+def complete_worker_job(worker_id, job_id):
+    parameters = request.json
+
+    schema = {
+        'exit_code': {'type': 'integer', 'required': True},
+        'log': {'type': 'string', 'required': True}
+    }
+    v = cerberus.Validator(schema)
+    if (not v.validate(parameters)):
+        abort(404, 'invalid request: {}'.format(v.errors))
+
+    with warm_pool_lock:
+        worker = worker_id_worker.get(worker_id)
+        if not worker:
+            abort(404)
+        if not worker.job or worker.job.id != job_id:
+            # a retry of a completion that was already received
+            return jsonify({})
+        job = worker.pool.job_done(worker)
+
+    job.mark_timestamp('terminated')
+    job.mark_timestamp('log_fetched')
+    # _set_result may deliver a callback, which can take up to its 120s
+    # timeout, so don't keep the worker waiting for it
+    worker_result_dispatcher.put(job.id, {
+        'type': 'COMPLETE',
+        'job': job,
+        'exit_code': parameters['exit_code'],
+        'log': parameters['log']
+    })
+    return jsonify({})
+
+def handle_worker_result(event):
+    job = event['job']
+    if not job.is_complete():
+        job._set_result(event['exit_code'], event['log'])
+
+worker_result_dispatcher = EventDispatcher(handle_worker_result, EVENT_WORKERS)
+
+@app.route('/warm_pools', methods=['GET'])
+def get_warm_pools():
+    with warm_pool_lock:
+        return jsonify([pool.to_json() for pool in warm_pools.values()])
+
+@app.route('/event_queue', methods=['GET'])
+def get_event_queue():
+    return jsonify(event_dispatcher.stats())
+
 def run_forever(target, *args, **kwargs):
     # target should be a function
     target_name = target.__name__
@@ -280,7 +1203,80 @@ def run_forever(target, *args, **kwargs):
             time.sleep(t / 1000.0)
 
 def flask_event_loop():
-    app.run(threaded=False, host='0.0.0.0')
+    # threaded so that long requests, like streaming batch results, don't
+    # block the rest of the API
+    app.run(threaded=True, host='0.0.0.0')
+
+def pack_event_loop():
+    while True:
+        time.sleep(PACK_POLL_SECS)
+        created_before = time.monotonic() - PACK_MAX_WAIT_SECS
+        with pack_lock:
+            for batch in batch_id_batch.copy().values():
+                batch.start_packs(created_before)
+
+def warm_pool_event_loop():
+    while True:
+        time.sleep(WARM_POOL_POLL_SECS)
+        idle_before = time.monotonic() - WARM_POOL_IDLE_SECS
+        actions = []
+        with warm_pool_lock:
+            for pool in list(warm_pools.values()):
+                actions.extend(pool.scale(idle_before))
+        run_warm_pool_actions(actions)
+
+def observed_timestamps(pod, now):
+    # lifecycle timestamps visible in a pod's status, taken when the event is
+    # read from the watch rather than when it is handled
+    observed = {}
+    if pod.status.conditions:
+        for condition in pod.status.conditions:
+            if condition.type == 'PodScheduled' and condition.status == 'True':
+                observed['scheduled'] = now
+    if pod.status.container_statuses:
+        state = pod.status.container_statuses[0].state
+        if state and state.running:
+            observed['running'] = now
+        if state and state.terminated:
+            observed['terminated'] = now
+    return observed
+
+def merge_kube_events(queued, new):
+    # handle the newest pod status, but keep the earliest time each phase was
+    # observed so coalescing doesn't lose, e.g., the running timestamp
+    observed = dict(new.get('observed', {}))
+    observed.update(queued.get('observed', {}))
+    new['observed'] = observed
+    return new
+
+def handle_kube_event(event):
+    event_type = event['type']
+    pod = event['object']
+    name = pod.metadata.name
+
+    # a pod runs a single job, a JobPack or a warm pool KubeWorker
+    job = pod_name_job.get(name)
+    if job and not job.is_complete():
+        if event_type == 'DELETE':
+            job.mark_unscheduled()
+        elif event_type == 'ADDED' or event_type == 'MODIFIED':
+            for phase in ['scheduled', 'running', 'terminated']:
+                if phase in event['observed']:
+                    job.mark_timestamp(phase, event['observed'][phase])
+
+            if pod.status.container_statuses:
+                assert len(pod.status.container_statuses) == 1
+                container_status = pod.status.container_statuses[0]
+                assert container_status.name == 'default'
+
+                if container_status.state and container_status.state.terminated:
+                    job.mark_complete(pod)
+        else:
+            log.error(f'handle_kube_event: saw unexpected event_type {event_type} in {event}')
+
+# handlers make blocking kube API calls, so events are handled by a pool of
+# threads partitioned by pod name, which keeps the events of a pod in order
+event_dispatcher = EventDispatcher(handle_kube_event, EVENT_WORKERS, merge_kube_events)
 
 def kube_event_loop():
     w = kube.watch.Watch()
@@ -292,24 +1288,23 @@ def kube_event_loop():
 
         log.debug(f'kube_event_loop: got event: {event_type} {pod.api_version}/{pod.kind} {name}')
 
-        job = pod_name_job.get(name)
-        if job and not job.is_complete():
-            if event_type == 'DELETE':
-                job.mark_unscheduled()
-            elif event_type == 'ADDED' or event_type == 'MODIFIED':
-                if pod.status.container_statuses:
-                    assert len(pod.status.container_statuses) == 1
-                    container_status = pod.status.container_statuses[0]
-                    assert container_status.name == 'default'
-
-                    if container_status.state and container_status.state.terminated:
-                        job.mark_complete(pod)
-            else:
-                log.error(f'kube_event_loop: saw unexpected event_type {event_type} in {event}')
+        if event_type == 'ADDED' or event_type == 'MODIFIED':
+            event['observed'] = observed_timestamps(pod, time.monotonic())
+        event_dispatcher.put(name, event)
+
+event_dispatcher.start()
+worker_result_dispatcher.start()
 
 kube_thread = threading.Thread(target=run_forever, args=(kube_event_loop,))
 kube_thread.start()
 
+pack_thread = threading.Thread(target=run_forever, args=(pack_event_loop,))
+pack_thread.start()
+
+if WARM_POOL:
+    warm_pool_thread = threading.Thread(target=run_forever, args=(warm_pool_event_loop,))
+    warm_pool_thread.start()
+
 # debug/reloader must run in main thread
 # see: https://stackoverflow.com/questions/31264826/start-a-flask-application-in-separate-thread
 # flask_thread = threading.Thread(target=flask_event_loop)
@@ -317,3 +1312,6 @@ kube_thread.start()
 run_forever(flask_event_loop)
 
 kube_thread.join()
+pack_thread.join()
+if WARM_POOL:
+    warm_pool_thread.join()
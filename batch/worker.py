@@ -0,0 +1,94 @@
+# warm pool worker: repeatedly asks the batch server for a job, runs it and
+# posts back its exit code and log.
+#
+#   python3 worker.py <batch url> <worker id>
+#
+# only uses the standard library, the server injects this source into worker
+# pods with `python3 -c` so it runs in the jobs' own image
+import sys
+import os
+import json
+import time
+import signal
+import subprocess
+import urllib.request
+import urllib.error
+
+# the server holds a request for a job open until one is available, these
+# only apply while the server can't be reached or fails
+MIN_RETRY_SECS = 0.1
+MAX_RETRY_SECS = 5
+
+current_process = None
+
+def post(url, d=None):
+    if d is None:
+        d = {}
+    req = urllib.request.Request(
+        url,
+        data = json.dumps(d).encode('utf-8'),
+        headers = {'Content-Type': 'application/json'},
+        method = 'POST')
+    with urllib.request.urlopen(req, timeout=60) as r:
+        return json.loads(r.read().decode('utf-8'))
+
+def run_job(job):
+    global current_process
+
+    env = dict(os.environ)
+    env.update(job['env'])
+    try:
+        current_process = subprocess.Popen(
+            job['command'], env = env, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+    except OSError as e:
+        # match the shell's exit code for a command that cannot be run
+        return 127, '{}\n'.format(e)
+    out, _ = current_process.communicate()
+    exit_code = current_process.returncode
+    current_process = None
+    return exit_code, out.decode('utf-8', 'replace')
+
+class Retired(Exception):
+    pass
+
+def post_with_retry(url, d=None):
+    # retries until the server answers, raises Retired if it no longer knows
+    # this worker
+    delay = MIN_RETRY_SECS
+    while True:
+        try:
+            return post(url, d)
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                raise Retired()
+            if e.code < 500:
+                raise
+        except urllib.error.URLError:
+            pass
+        time.sleep(delay)
+        delay = min(delay * 2, MAX_RETRY_SECS)
+
+def run(url, worker_id):
+    next_url = '{}/workers/{}/next'.format(url, worker_id)
+
+    try:
+        while True:
+            job = post_with_retry(next_url)
+            if not job:
+                # the server waited and no job was submitted, ask again
+                continue
+
+            exit_code, log = run_job(job)
+            post_with_retry('{}/workers/{}/jobs/{}/complete'.format(url, worker_id, job['id']),
+                            {'exit_code': exit_code, 'log': log})
+    except Retired:
+        return
+
+def terminate(signum, frame):
+    if current_process:
+        current_process.kill()
+    sys.exit(0)
+
+if __name__ == '__main__':
+    signal.signal(signal.SIGTERM, terminate)
+    run(sys.argv[1], int(sys.argv[2]))
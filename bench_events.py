@@ -0,0 +1,49 @@
+import sys
+import time
+from types import SimpleNamespace
+from batch.events import EventDispatcher
+
+# synthetic watch stream: each pod goes through ADDED, a few MODIFIED while
+# pending and running, then a MODIFIED with a terminated container. handling
+# a completion sleeps for about one kube API round-trip, like mark_complete.
+
+N_PODS = 2000
+N_INTERMEDIATE_MODIFIED = 3
+API_LATENCY_SECS = 0.005
+
+def synthetic_events(n_pods):
+    names = ['job-{}-abcde'.format(i) for i in range(n_pods)]
+    for name in names:
+        yield name, {'type': 'ADDED', 'object': SimpleNamespace(name=name, terminated=False)}
+    for _ in range(N_INTERMEDIATE_MODIFIED):
+        for name in names:
+            yield name, {'type': 'MODIFIED', 'object': SimpleNamespace(name=name, terminated=False)}
+    for name in names:
+        yield name, {'type': 'MODIFIED', 'object': SimpleNamespace(name=name, terminated=True)}
+
+def bench(n_workers, n_pods):
+    completed = []
+
+    def handler(event):
+        if event['object'].terminated:
+            time.sleep(API_LATENCY_SECS)
+            completed.append(event['object'].name)
+
+    dispatcher = EventDispatcher(handler, n_workers)
+    dispatcher.start()
+
+    start = time.time()
+    for name, event in synthetic_events(n_pods):
+        dispatcher.put(name, event)
+    dispatcher.wait_idle()
+    elapsed = time.time() - start
+
+    assert len(completed) == n_pods
+    stats = dispatcher.stats()
+    print('workers {:3}: {:8.1f} completions/s, {} events handled, {} coalesced'.format(
+        n_workers, n_pods / elapsed, stats['processed'], stats['coalesced']))
+
+if __name__ == '__main__':
+    n_pods = int(sys.argv[1]) if len(sys.argv) > 1 else N_PODS
+    for n_workers in [1, 4, 16, 64]:
+        bench(n_workers, n_pods)
@@ -5,7 +5,7 @@ python batch/server.py &
 
 sleep 5
 
-POD_IP='127.0.0.1' BATCH_URL='http://127.0.0.1:5000' python -m unittest test/test_batch.py
+POD_IP='127.0.0.1' BATCH_URL='http://127.0.0.1:5000' python -m unittest test/test_batch.py test/test_events.py
 EXIT_CODE=$?
 
 exit $EXIT_CODE
@@ -1,6 +1,7 @@
 import threading
 import time
 import os
+import signal
 import unittest
 import batch
 import requests
@@ -43,6 +44,26 @@ class ServerThread(threading.Thread):
     def shutdown(self):
         self.server.shutdown()
 
+def wait_until(f, timeout=60):
+    start = time.time()
+    while True:
+        result = f()
+        if result:
+            return result
+        if time.time() - start > timeout:
+            raise AssertionError('timed out after {}s'.format(timeout))
+        time.sleep(0.1)
+
+# the server must run with BATCH_WARM_POOL=local, see make test-local-warm-pool
+local_warm_pool = unittest.skipUnless(
+    os.environ.get('BATCH_WARM_POOL') == 'local',
+    'requires a server with BATCH_WARM_POOL=local')
+
+# with a warm pool, jobs don't get pods of their own
+pod_per_job = unittest.skipIf(
+    os.environ.get('BATCH_WARM_POOL'),
+    'requires a server without BATCH_WARM_POOL')
+
 class Test(unittest.TestCase):
     def setUp(self):
         self.batch = batch.client.BatchClient(
@@ -138,6 +159,225 @@ class Test(unittest.TestCase):
         self.assertTrue(bstatus['jobs']['Cancelled'] == 1)
         self.assertTrue(bstatus['jobs']['Complete'] == 2)
 
+    def test_batch_results(self):
+        b = self.batch.create_batch()
+        j1 = b.create_job('alpine', ['true'], attributes={'foo': 'bar'})
+        j2 = b.create_job('alpine', ['false'])
+        b.wait()
+
+        results = list(b.results())
+        self.assertEqual([r['id'] for r in results], [j1.id, j2.id])
+        self.assertEqual(results[0]['exit_code'], 0)
+        self.assertEqual(results[0]['attributes'], {'foo': 'bar'})
+        self.assertEqual(results[1]['exit_code'], 1)
+        self.assertTrue('attributes' not in results[1])
+        self.assertEqual(results[1]['log_path'], '/jobs/{}/log'.format(j2.id))
+
+        resumed = list(b.results(after=j1.id))
+        self.assertEqual([r['id'] for r in resumed], [j2.id])
+
+    def test_batch_results_resume_after_delete(self):
+        b = self.batch.create_batch()
+        j1 = b.create_job('alpine', ['true'])
+        j2 = b.create_job('alpine', ['true'])
+        j3 = b.create_job('alpine', ['true'])
+        b.wait()
+
+        first = next(b.results())
+        self.assertEqual(first['id'], j1.id)
+        j2.delete()
+
+        resumed = list(b.results(after=first['id']))
+        self.assertEqual([r['id'] for r in resumed], [j3.id])
+
+    @pod_per_job
+    def test_job_timestamps(self):
+        j = self.batch.create_job('alpine', ['true'])
+        status = j.wait()
+        timestamps = status['timestamps']
+        self.assertEqual(timestamps['created'], 0)
+        self.assertTrue(timestamps['pod_created'] <= timestamps['terminated'])
+        self.assertTrue(timestamps['terminated'] <= timestamps['log_fetched'])
+        self.assertTrue(timestamps['log_fetched'] <= timestamps['complete'])
+
+    @pod_per_job
+    def test_batch_timings(self):
+        b = self.batch.create_batch()
+        b.create_job('alpine', ['true'])
+        b.create_job('alpine', ['true'])
+        b.wait()
+
+        timings = b.timings()
+        self.assertEqual(timings['total']['count'], 2)
+        self.assertTrue(timings['total']['p50'] <= timings['total']['max'])
+        self.assertTrue('pod_creation' in timings)
+        self.assertTrue('callback' not in timings)
+
+    def test_cancel_batch(self):
+        b = self.batch.create_batch()
+        j1 = b.create_job('alpine', ['true'])
+        j2 = b.create_job('alpine', ['sleep', '30'])
+        j3 = b.create_job('alpine', ['sleep', '30'])
+        j1.wait()
+
+        b.cancel()
+        bstatus = b.wait()
+        self.assertEqual(bstatus['jobs']['Complete'], 1)
+        self.assertEqual(bstatus['jobs']['Cancelled'], 2)
+        self.assertEqual(j2.status()['state'], 'Cancelled')
+
+    def test_delete_batch(self):
+        b = self.batch.create_batch()
+        j = b.create_job('alpine', ['sleep', '30'])
+        b.delete()
+
+        # verify batch and its jobs don't exist
+        for get in [lambda: b.status(), lambda: self.batch._get_job(j.id)]:
+            try:
+                get()
+                self.fail('expected 404')
+            except requests.HTTPError as e:
+                if e.response.status_code == 404:
+                    pass
+                else:
+                    raise
+
+    def test_packed_batch(self):
+        b = self.batch.create_batch(pack_size=3, pack_parallelism=2)
+        j1 = b.create_job('alpine', ['echo', 'one'])
+        j2 = b.create_job('alpine', ['sh', '-c', 'echo $FOO; exit 2'], env={'FOO': 'two'})
+        j3 = b.create_job('alpine', ['false'])
+        # incomplete pack started after waiting
+        j4 = b.create_job('alpine', ['echo', 'four'])
+        b.wait()
+
+        status = j1.status()
+        self.assertEqual(status['exit_code'], 0)
+        self.assertEqual(status['log'], 'one\n')
+        status = j2.status()
+        self.assertEqual(status['exit_code'], 2)
+        self.assertEqual(status['log'], 'two\n')
+        self.assertEqual(j3.status()['exit_code'], 1)
+        self.assertEqual(j4.status()['log'], 'four\n')
+
+    def test_packed_batch_resources(self):
+        b = self.batch.create_batch(pack_size=2, pack_parallelism=2)
+        resources = {'requests': {'cpu': '50m', 'memory': '16Mi'}}
+        j1 = b.create_job('alpine', ['true'], resources=resources)
+        j2 = b.create_job('alpine', ['true'], resources=resources)
+        b.wait()
+
+        self.assertEqual(j1.status()['exit_code'], 0)
+        self.assertEqual(j2.status()['exit_code'], 0)
+
+    def test_cancel_packed_job(self):
+        b = self.batch.create_batch(pack_size=3)
+        j1 = b.create_job('alpine', ['sleep', '30'])
+        j2 = b.create_job('alpine', ['true'])
+        j3 = b.create_job('alpine', ['sleep', '30'])
+        # j1 runs first, j2 and j3 wait behind it
+        wait_until(lambda: 'running' in j1.status()['timestamps'])
+
+        start = time.time()
+        j1.cancel()
+        j3.cancel()
+        b.wait()
+
+        self.assertEqual(j1.status()['state'], 'Cancelled')
+        self.assertEqual(j3.status()['state'], 'Cancelled')
+        self.assertEqual(j2.status()['exit_code'], 0)
+        # the cancelled sleeps were killed or skipped, not waited for
+        self.assertTrue(time.time() - start < 20)
+
+    def test_worker(self):
+        app = Flask('test-worker')
+
+        jobs = [
+            {'id': 1, 'command': ['sh', '-c', 'echo $FOO'], 'env': {'FOO': 'bar'}},
+            {},
+            {'id': 2, 'command': ['false'], 'env': {}}
+        ]
+        d = {}
+
+        @app.route('/workers/7/next', methods=['POST'])
+        def next_job():
+            if not jobs:
+                # retire the worker
+                return Response(status=404)
+            return jsonify(jobs.pop(0))
+
+        @app.route('/workers/7/jobs/<int:job_id>/complete', methods=['POST'])
+        def complete(job_id):
+            d[job_id] = request.get_json()
+            return jsonify({})
+
+        port = 5870
+        server = ServerThread(app, host=self.ip, port=port)
+        server.start()
+
+        batch.worker.run('http://{}:{}'.format(self.ip, port), 7)
+
+        self.assertEqual(d[1], {'exit_code': 0, 'log': 'bar\n'})
+        self.assertEqual(d[2]['exit_code'], 1)
+
+        server.shutdown()
+        server.join()
+
+    def warm_pool_worker(self, job_id):
+        for pool in self.batch._list_warm_pools():
+            for worker in pool['workers']:
+                if worker['job'] == job_id:
+                    return worker
+        return None
+
+    @local_warm_pool
+    def test_warm_pool_dispatch(self):
+        j = self.batch.create_job('alpine', ['echo', 'test'])
+        status = j.wait()
+        self.assertEqual(status['exit_code'], 0)
+        self.assertEqual(status['log'], 'test\n')
+        self.assertTrue('dispatched' in status['timestamps'])
+        self.assertTrue('pod_created' not in status['timestamps'])
+
+    @local_warm_pool
+    def test_warm_pool_requeue_on_worker_exit(self):
+        j = self.batch.create_job('alpine', ['sleep', '2'])
+        worker = wait_until(lambda: self.warm_pool_worker(j.id))
+        os.kill(worker['pid'], signal.SIGKILL)
+
+        status = j.wait()
+        self.assertEqual(status['exit_code'], 0)
+        worker2 = self.warm_pool_worker(j.id)
+        self.assertTrue(worker2 is None or worker2['id'] != worker['id'])
+
+    @local_warm_pool
+    def test_warm_pool_cancel_stops_worker(self):
+        j = self.batch.create_job('alpine', ['sleep', '30'])
+        worker = wait_until(lambda: self.warm_pool_worker(j.id))
+        j.cancel()
+        self.assertEqual(j.status()['state'], 'Cancelled')
+
+        worker_ids = [w['id'] for pool in self.batch._list_warm_pools() for w in pool['workers']]
+        self.assertTrue(worker['id'] not in worker_ids)
+        # the worker process was terminated and reaped
+        with self.assertRaises(ProcessLookupError):
+            os.kill(worker['pid'], 0)
+
+    @local_warm_pool
+    def test_warm_pool_scale(self):
+        jobs = [self.batch.create_job('alpine', ['sleep', '3']) for _ in range(3)]
+        # each queued job beyond the idle workers starts another worker
+        wait_until(lambda: all(self.warm_pool_worker(j.id) for j in jobs))
+        worker_ids = set(self.warm_pool_worker(j.id)['id'] for j in jobs)
+        self.assertEqual(len(worker_ids), 3)
+        for j in jobs:
+            j.wait()
+
+        # idle workers are stopped down to the minimum
+        idle_secs = float(os.environ.get('BATCH_WARM_POOL_IDLE_SECS', 60))
+        wait_until(lambda: all(len(pool['workers']) <= 1 for pool in self.batch._list_warm_pools()),
+                   timeout = idle_secs + 10)
+
     def test_callback(self):
         app = Flask('test-client')
 
@@ -0,0 +1,91 @@
+import threading
+import unittest
+from batch.events import EventDispatcher
+
+class Test(unittest.TestCase):
+    def test_per_name_order(self):
+        handled = {}
+        lock = threading.Lock()
+
+        def handler(event):
+            with lock:
+                handled.setdefault(event['name'], []).append(event['i'])
+
+        dispatcher = EventDispatcher(handler, 4)
+        dispatcher.start()
+        for i in range(100):
+            for name in ['a', 'b', 'c', 'd', 'e']:
+                dispatcher.put(name, {'type': 'ADDED', 'name': name, 'i': i})
+        dispatcher.wait_idle()
+
+        for name in ['a', 'b', 'c', 'd', 'e']:
+            self.assertEqual(handled[name], list(range(100)))
+        self.assertEqual(dispatcher.stats()['processed'], 500)
+
+    def test_coalesce_modified(self):
+        handled = []
+        blocked = threading.Event()
+        release = threading.Event()
+
+        def handler(event):
+            if event['name'] == 'block':
+                blocked.set()
+                release.wait()
+            handled.append((event['type'], event['name'], event['i']))
+
+        dispatcher = EventDispatcher(handler, 1)
+        dispatcher.start()
+
+        # hold the worker so later events queue up behind it
+        dispatcher.put('block', {'type': 'ADDED', 'name': 'block', 'i': 0})
+        blocked.wait()
+
+        dispatcher.put('a', {'type': 'MODIFIED', 'name': 'a', 'i': 1})
+        dispatcher.put('a', {'type': 'MODIFIED', 'name': 'a', 'i': 2})
+        dispatcher.put('a', {'type': 'DELETE', 'name': 'a', 'i': 3})
+        dispatcher.put('a', {'type': 'MODIFIED', 'name': 'a', 'i': 4})
+        dispatcher.put('a', {'type': 'MODIFIED', 'name': 'a', 'i': 5})
+
+        stats = dispatcher.stats()
+        self.assertEqual(stats['depth'], 3)
+        self.assertEqual(stats['coalesced'], 2)
+        self.assertTrue(stats['lag_secs'] >= 0)
+
+        release.set()
+        dispatcher.wait_idle()
+
+        self.assertEqual(handled, [
+            ('ADDED', 'block', 0),
+            ('MODIFIED', 'a', 2),
+            ('DELETE', 'a', 3),
+            ('MODIFIED', 'a', 5)
+        ])
+
+    def test_merge(self):
+        handled = []
+        blocked = threading.Event()
+        release = threading.Event()
+
+        def handler(event):
+            if event['name'] == 'block':
+                blocked.set()
+                release.wait()
+            handled.append(event)
+
+        def merge(queued, new):
+            new['seen'] = queued['seen'] + new['seen']
+            return new
+
+        dispatcher = EventDispatcher(handler, 1, merge)
+        dispatcher.start()
+
+        dispatcher.put('block', {'type': 'ADDED', 'name': 'block', 'seen': []})
+        blocked.wait()
+
+        dispatcher.put('a', {'type': 'MODIFIED', 'name': 'a', 'seen': ['running']})
+        dispatcher.put('a', {'type': 'MODIFIED', 'name': 'a', 'seen': ['terminated']})
+
+        release.set()
+        dispatcher.wait_idle()
+
+        self.assertEqual(handled[1]['seen'], ['running', 'terminated'])